@@ -8,13 +8,28 @@ import subprocess
 import time
 import re
 import datetime
+import collections
+import json
+import cProfile
+import threading
+import argparse
+import getpass
+import shutil
+import signal
 import requests
 import xml.etree.ElementTree as ET
 import six
 from six.moves.urllib import parse
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:   # watch mode falls back to polling the spool directory
+    INotify = None
 
 
-USER = subprocess.check_output("logname", shell=True).rstrip().decode("utf-8")
+try:
+    USER = subprocess.check_output("logname", shell=True, stderr=subprocess.DEVNULL).rstrip().decode("utf-8")
+except subprocess.CalledProcessError:   # no login session, e.g. when running as a service
+    USER = getpass.getuser()
 USER_HOME_DIR = os.path.join("/home", str(USER))
 VERSION="1.0-nc14"
 
@@ -23,6 +38,7 @@ VERSION="1.0-nc14"
 
 class ResponseError(Exception):
     def __init__(self, res, errorType):
+        self.res = None
         if type(res) is int:
             code = res
         else:
@@ -39,8 +55,41 @@ class ResponseError(Exception):
 
 
 class OCSResponseError(ResponseError):
-    def __init__(self, res):
+    # status codes of the provisioning API (POST cloud/users)
+    INVALID_INPUT = 101
+    USER_EXISTS = 102
+    UNKNOWN_ERROR = 103
+    GROUP_NOT_FOUND = 104
+    GROUP_NOT_PERMITTED = 105
+    NO_GROUP = 106
+    HINT = 107
+    NO_PASSWORD_OR_EMAIL = 108
+
+    ERROR_CLASSES = {
+        INVALID_INPUT: "invalid input data",
+        USER_EXISTS: "username already exists",
+        UNKNOWN_ERROR: "unknown error occurred whilst adding the user",
+        GROUP_NOT_FOUND: "group does not exist",
+        GROUP_NOT_PERMITTED: "insufficient privileges for group",
+        NO_GROUP: "insufficent rights to create users in this group",
+        HINT: "rejected by the server (e.g. password policy)",
+        NO_PASSWORD_OR_EMAIL: "password and email empty",
+    }
+
+    def __init__(self, res, ocs_code=None):
+        """
+        :param res: response or status code
+        :param ocs_code: status code from meta/statuscode, None if the request failed on HTTP level
+        """
         ResponseError.__init__(self, res, "OCS")
+        self.ocs_code = ocs_code
+
+    @property
+    def error_class(self):
+        """human readable class of the OCS status code"""
+        if self.ocs_code is None:
+            return "HTTP error %i" % self.status_code
+        return self.ERROR_CLASSES.get(self.ocs_code, "OCS error %i" % self.ocs_code)
 
     def get_resource_body(self):
         if self.res is not None:
@@ -62,6 +111,89 @@ class HTTPResponseError(ResponseError):
 
 
 
+class JsonlTraceWriter(object):
+    """Trace hook that appends every span as one compact json line to a file"""
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RequestTracer(object):
+    """Wraps OCS requests in spans and hands every finished span to the registered hooks
+
+    A span is a plain dict. OCS requests record endpoint, status, ocs_code, bytes,
+    parse_time and wall_time (seconds), Qt signals record their emit time.
+    """
+
+    def __init__(self, trace_path=None, profile_path=None):
+        """
+        :param trace_path: write all spans to this jsonl file, defaults to None
+        :param profile_path: dump a cProfile/pstats file of the worker to this path, defaults to None
+        """
+        self._hooks = []
+        self._profile_path = profile_path
+        self._profiler = None
+        if trace_path:
+            self.add_hook(JsonlTraceWriter(trace_path))
+
+    @property
+    def profile_path(self):
+        return self._profile_path
+
+    def add_hook(self, hook):
+        """Registers a callable that receives every finished span (a dict)"""
+        self._hooks.append(hook)
+
+    def emit(self, span):
+        span['ts'] = time.time()
+        for hook in self._hooks:
+            hook(span)
+
+    def start_profile(self):
+        """Enables cProfile - only the calling thread is profiled"""
+        if self._profile_path and self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop_profile(self):
+        """Disables cProfile and writes the pstats dump"""
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile_path)
+            self._profiler = None
+
+    def close(self):
+        self.stop_profile()
+        for hook in self._hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+
+def tracer_from_environment():
+    """Creates a RequestTracer if NEXTCLOUDUSERS_TRACE and/or NEXTCLOUDUSERS_PROFILE are set
+
+    :returns: RequestTracer instance or None
+    """
+    trace_path = os.environ.get('NEXTCLOUDUSERS_TRACE')
+    profile_path = os.environ.get('NEXTCLOUDUSERS_PROFILE')
+    if not trace_path and not profile_path:
+        return None
+    return RequestTracer(trace_path, profile_path)
+
+
+
+
 
 
 
@@ -100,6 +232,7 @@ class Client(object):
         :param dav_endpoint_version: None (default) to force using a specific endpoint version
         instead of relying on capabilities
         :param debug: set to True to print debugging messages to stdout, defaults to False
+        :param tracer: RequestTracer that receives a span for every OCS request, defaults to None
         """
         if not url.endswith('/'):
             url += '/'
@@ -108,7 +241,7 @@ class Client(object):
         self._session = None
         self._debug = kwargs.get('debug', False)
         self._verify_certs = kwargs.get('verify_certs', True)
-   
+        self._tracer = kwargs.get('tracer', None)
 
         self._capabilities = None
         self._version = None
@@ -169,7 +302,7 @@ class Client(object):
 
         # We get 200 when the user was just created.
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
             self._check_ocs_status(tree, [100])
             return True
 
@@ -209,7 +342,7 @@ class Client(object):
         )
 
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
             users = [x.text for x in tree.findall('data/users/element')]
 
             return users
@@ -237,7 +370,7 @@ class Client(object):
         )
 
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
             self._check_ocs_status(tree, [100])
             return True
 
@@ -261,7 +394,7 @@ class Client(object):
         )
 
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
 
             for code_el in tree.findall('data/groups/element'):
                 if code_el is not None and code_el.text == group_name:
@@ -305,7 +438,7 @@ class Client(object):
                 msg_el = tree  # fallback to the entire ocs response, if we find no message.
             r._content = ET.tostring(msg_el)
             r.status_code = int(code_el.text)
-            raise OCSResponseError(r)
+            raise OCSResponseError(r, ocs_code=r.status_code)
 
 
     def make_ocs_request(self, method, service, action, **kwargs):
@@ -322,7 +455,7 @@ class Client(object):
 
         res = self._make_ocs_request(method, service, action, **kwargs)
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
             self._check_ocs_status(tree, accepted_codes=accepted_codes)
             return res
 
@@ -352,12 +485,61 @@ class Client(object):
 
         if self._debug:
             print('OCS request: %s %s %s' % (method, self.url + path,
-                                             attributes))
+                                             self._mask_attributes(attributes)))
+
+        if self._tracer is None:
+            return self._session.request(method, self.url + path, **attributes)
 
-        res = self._session.request(method, self.url + path, **attributes)
+        span = {'kind': 'ocs', 'method': method, 'endpoint': path.split('?', 1)[0], 'ocs_code': None, 'parse_time': 0.0,
+                'status': None, 'bytes': 0, 'error': None}
+        start = time.perf_counter()
+        try:
+            res = self._session.request(method, self.url + path, **attributes)
+            span['status'] = res.status_code
+            span['bytes'] = len(res.content)
+
+            if res.status_code == 200:
+                parse_start = time.perf_counter()
+                try:
+                    code_el = self._response_tree(res).find('meta/statuscode')
+                    if code_el is not None:
+                        span['ocs_code'] = int(code_el.text)
+                except ET.ParseError:
+                    pass
+                span['parse_time'] = time.perf_counter() - parse_start
+        except Exception as e:   # timeouts and connection errors are traced as well
+            span['error'] = "%s: %s" % (type(e).__name__, e)
+            raise
+        finally:
+            span['wall_time'] = time.perf_counter() - start
+            self._tracer.emit(span)
         return res
 
 
+    @staticmethod
+    def _response_tree(res):
+        """Parses the xml body of an OCS response only once and caches the tree on the response
+
+        :param res: :class:`requests.Response` instance
+        :returns: xml.etree.ElementTree.Element
+        """
+        tree = getattr(res, '_ocs_tree', None)
+        if tree is None:
+            tree = ET.fromstring(res.content)
+            res._ocs_tree = tree
+        return tree
+
+
+    @staticmethod
+    def _mask_attributes(attributes):
+        """Returns a copy of the request attributes with passwords blanked out (for debug output)"""
+        masked = attributes.copy()
+        data = masked.get('data')
+        if isinstance(data, dict) and 'password' in data:
+            masked['data'] = dict(data, password='********')
+        return masked
+
+
     def _xml_to_dict(self, element):
         """
         Take an XML element, iterate over it and build a dict
@@ -384,7 +566,7 @@ class Client(object):
                 'capabilities'
                 )
         if res.status_code == 200:
-            tree = ET.fromstring(res.content)
+            tree = self._response_tree(res)
             self._check_ocs_status(tree)
 
             data_el = tree.find('data')
@@ -423,6 +605,630 @@ class Client(object):
 
 
 
+class UserIndex(object):
+    """Thread safe set of existing usernames, loaded once with a single search request"""
+
+    def __init__(self, confirm=False):
+        """
+        :param confirm: True to double check a taken username with the server before reporting it,
+        for long running processes where users may have been deleted since warm_up(). Defaults to False
+        """
+        self._users = set()
+        self._lock = threading.Lock()
+        self._confirm = confirm
+
+    def warm_up(self, ocinstance):
+        """Loads all usernames of the instance
+
+        :param ocinstance: logged in instance of the owncloud/nextcloud client
+        """
+        users = ocinstance.search_users('')
+        with self._lock:
+            self._users.update(users)
+
+    def claim(self, user_name, ocinstance=None):
+        """Reserves a username
+
+        :param ocinstance: client used to confirm a taken username if the index was created with confirm=True
+        :returns: False if the username already exists
+        """
+        with self._lock:
+            if user_name not in self._users:
+                self._users.add(user_name)
+                return True
+        if self._confirm and ocinstance is not None:
+            return not ocinstance.user_exists(user_name)   # deleted in the meantime, the entry stays claimed
+        return False
+
+    def release(self, user_name):
+        """Gives back a claimed username, e.g. if the account could not be created"""
+        with self._lock:
+            self._users.discard(user_name)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
+
+
+
+
+SPECIALCHARS = [
+    ("[âáà]", "a"), ("[ä]", "ae"), ("[èéêěë]", "e"), ("[ìíǐîï]", "i"), ("[òǒóôõ]", "o"),
+    ("[ö]", "oe"), ("[ùǔúû]", "u"), ("[ü]", "ue"), ("[ćĉč]", "c"), ("[ß]", "ss"),
+]
+
+
+def normalize_user(user):
+    """lowercases name and surname, removes blanks and replaces specialcharacters in place
+
+    :param user: list [name, surname, password]
+    :returns: True if specialcharacters have been replaced
+    """
+    changed = False
+    for i in (0, 1):
+        name = user[i].lower().replace(" ", "")
+        replaced = name
+        for pattern, replacement in SPECIALCHARS:
+            replaced = re.sub(pattern, replacement, replaced)
+        changed = changed or replaced != name
+        user[i] = replaced
+    return changed
+
+
+class UserfileError(IOError):
+    """Reading a csv file failed, file_path and line tell where reading stopped"""
+
+    def __init__(self, file_path, line, error):
+        if line:
+            IOError.__init__(self, "%s:%d: %s" % (os.path.basename(file_path), line, error))
+        else:
+            IOError.__init__(self, "%s: %s" % (os.path.basename(file_path), error))
+        self.file_path = file_path
+        self.line = line
+
+
+def iter_userfile(file_path, report, stats=None):
+    """parses a comma separated textfile csv for usernames and passwords
+    and replaces all specialcharacters in usernames
+    lines are decoded one by one, a line that is not valid utf-8 is skipped and reported
+
+    :param file_path: path of the csv file
+    :param report: callable that receives a line for every skipped row
+    :param stats: collections.Counter that counts 'rows', 'changed' and 'skipped', defaults to None
+    :returns: generator of lists [name, surname, password, source file, line number]
+    :raises: UserfileError if the file can not be read
+    """
+    if stats is None:
+        stats = collections.Counter()
+    filename = os.path.basename(file_path)
+    try:
+        userfile = open(file_path, 'rb')
+    except (IOError, OSError) as e:
+        raise UserfileError(file_path, 0, e)
+
+    count = 0
+    with userfile:
+        while True:
+            try:
+                rawline = userfile.readline()
+            except (IOError, OSError) as e:
+                raise UserfileError(file_path, count + 1, e)
+            if not rawline:
+                break
+            count += 1
+            try:
+                line = rawline.decode('utf-8')
+            except UnicodeDecodeError:
+                report("Line %d in '%s' is not utf-8 encoded. Skip." % (count, filename))
+                stats['skipped'] += 1
+                continue
+            if line.strip() == "":
+                continue
+            fields = [final.strip() for final in line.split(',')]
+            if not len(fields) in [3]:
+                report("%d fields: %s" %(len(fields), fields))
+                report("Line %d in '%s' has less or more than 3 fields. Skip." % (count, filename))
+                stats['skipped'] += 1
+                continue
+            if normalize_user(fields):
+                stats['changed'] += 1
+            stats['rows'] += 1
+            yield fields + [file_path, count]
+
+
+def expand_userfiles(paths):
+    """replaces directories by the csv files they contain (replay files *.failed.csv and *.taken.csv are left out)
+
+    :param paths: list of csv files and/or directories
+    :returns: list of csv files
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.csv') and not name.endswith(('.failed.csv', '.taken.csv')) and os.path.isfile(os.path.join(path, name)):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+
+def merge_userfiles(paths, report, stats=None):
+    """streams the rows of several csv files as one batch, rows are deduplicated
+    across all files by their normalized username
+
+    :param paths: list of csv files and/or directories
+    :param report: callable that receives a line for every skipped row
+    :param stats: collections.Counter, counts 'duplicates' in addition to the counts of iter_userfile()
+    :returns: generator of lists [name, surname, password, source file, line number]
+    :raises: UserfileError if a file can not be read
+    """
+    if stats is None:
+        stats = collections.Counter()
+    seen = {}   # username -> row that provides it
+    for file_path in expand_userfiles(paths):
+        for user in iter_userfile(file_path, report, stats):
+            username = "%s.%s" %(user[0],user[1])
+            first = seen.get(username)
+            if first is not None:
+                report("Duplicate username '%s' in %s is already defined in %s. Skip." % (username, row_source(user), row_source(first)))
+                stats['duplicates'] += 1
+                continue
+            seen[username] = user
+            yield user
+
+
+def row_source(user):
+    """returns 'file.csv:line' of a parsed row"""
+    if len(user) < 5:
+        return "?"
+    return "%s:%d" % (os.path.basename(user[3]), user[4])
+
+
+def classify_error(e):
+    """returns the error class an exception is reported and grouped by"""
+    if isinstance(e, OCSResponseError):
+        return e.error_class
+    if isinstance(e, HTTPResponseError):
+        return "HTTP error %i" % e.status_code
+    return type(e).__name__
+
+
+class RunSummary(object):
+    """Outcome of a provisioning run, failures and warnings are grouped by error class"""
+
+    ALREADY_TAKEN = "username already taken"
+    GROUP_FAILED = "adding to group failed"
+    NOT_PROCESSED = "not processed"
+
+    def __init__(self):
+        self.created = 0
+        self.failures = []   # tuples (user, username, errorclass, taken)
+        self.warnings = []   # tuples (user, username, warningclass), the account has been created
+        self.aborted = None   # exception that stopped the run
+
+    def add_failure(self, user, errorclass, taken=False):
+        """
+        :param user: list [name, surname, password, source file, line number]
+        :param errorclass: see classify_error()
+        :param taken: True if the username exists, the row goes to the taken file instead of the replay file
+        """
+        username = "%s.%s (%s)" % (user[0], user[1], row_source(user))
+        self.failures.append((user, username, errorclass, taken))
+
+    def add_warning(self, user, warningclass):
+        username = "%s.%s (%s)" % (user[0], user[1], row_source(user))
+        self.warnings.append((user, username, warningclass))
+
+    def abort(self, users, e):
+        """marks the run as aborted, the rows that were not processed are written to the replay file"""
+        self.aborted = e
+        for user in users:
+            self.add_failure(user, self.NOT_PROCESSED)
+
+    @staticmethod
+    def grouped(entries):
+        """:returns: dict errorclass -> list of usernames, in order of first occurrence"""
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry[2], []).append(entry[1])
+        return groups
+
+    def summary_lines(self):
+        lines = ["%d created, %d failed, %d warnings" % (self.created, len(self.failures), len(self.warnings))]
+        if self.aborted is not None:
+            lines.append("Run aborted: %s" % self.aborted)
+        for errorclass, usernames in self.grouped(self.failures).items():
+            lines.append("%d x %s: %s" % (len(usernames), errorclass, ", ".join(usernames)))
+        for warningclass, usernames in self.grouped(self.warnings).items():
+            lines.append("%d x warning %s: %s" % (len(usernames), warningclass, ", ".join(usernames)))
+        return lines
+
+    def write_replay(self, path):
+        """writes all failed rows that can be retried in the input format, so the file can be
+        fixed and loaded again. A replay file left over from an earlier run is removed if nothing failed.
+
+        :returns: number of rows written
+        """
+        return self._write_rows(path, [user for user, username, errorclass, taken in self.failures if not taken])
+
+    def write_taken(self, path):
+        """writes all rows whose username already exists in the input format, so they can be renamed
+        and loaded again. A file left over from an earlier run is removed if there are none.
+
+        :returns: number of rows written
+        """
+        return self._write_rows(path, [user for user, username, errorclass, taken in self.failures if taken])
+
+    @staticmethod
+    def _write_rows(path, rows):
+        if rows:
+            with open(path, 'w') as rowfile:
+                for user in rows:
+                    rowfile.write(",".join(user[:3]) + "\n")
+        elif os.path.exists(path):
+            os.remove(path)
+        return len(rows)
+
+
+def replay_path(file_path, kind="failed"):
+    """returns the path of the replay file for a csv file: users.csv -> users.failed.csv
+    (a replay file that is loaded again is overwritten with the remaining failures)
+
+    :param kind: "failed" for rows that can be retried, "taken" for rows whose username exists
+    """
+    root, ext = os.path.splitext(file_path)
+    if root.endswith("." + kind):
+        return file_path
+    return root + "." + kind + (ext or ".csv")
+
+
+def batch_replay_path(file_paths, kind="failed"):
+    """returns the path of the replay file for a batch of csv files,
+    batch.failed.csv in their common directory if there is more than one"""
+    if len(file_paths) == 1:
+        return replay_path(file_paths[0], kind)
+    directory = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in file_paths])
+    return os.path.join(directory, "batch.%s.csv" % kind)
+
+
+def provision_users(ocinstance, group, users, report, userindex=None):
+    """creates all user accounts and adds them to the group
+
+    :param ocinstance: logged in instance of the owncloud/nextcloud client
+    :param group: name of the group user is to be addded
+    :param users: list or iterator (e.g. merge_userfiles()) of lists [name, surname, password, source file, line number]
+    :param report: callable that receives a progress or error line
+    :param userindex: warmed up UserIndex, if None every username is checked with a search request
+    :returns: RunSummary
+    """
+    summary = RunSummary()
+    rows = iter(users)
+    while True:
+        try:
+            user = next(rows)
+        except StopIteration:
+            break
+        except UserfileError as e:   # reading stopped, rows after that line are unknown
+            summary.abort([], e)
+            report("<b>ERROR</b> Reading stopped at %s | the rest of the file has not been processed" % e)
+            break
+
+        try:
+            _provision_user(ocinstance, group, user, report, userindex, summary)
+        except Exception as e:   # e.g. connection lost - the remaining rows go to the replay file
+            remaining = [user]
+            try:
+                remaining.extend(rows)
+            except UserfileError as readerror:
+                report("<b>ERROR</b> Reading stopped at %s | the rest of the file has not been processed" % readerror)
+            summary.abort(remaining, e)
+            report("<b>ERROR</b> Run aborted: %s | %d rows not processed" %(e, len(remaining)) )
+            break
+    return summary
+
+
+def _provision_user(ocinstance, group, user, report, userindex, summary):
+    """creates a single account, errors of the account are recorded in summary"""
+    username = "%s.%s" %(user[0],user[1])
+    password = user[2]
+
+    if userindex is not None:
+        userexists = not userindex.claim(username, ocinstance)
+    else:
+        userexists = ocinstance.user_exists(username)
+    if userexists:    #check if user exists
+        report("<b>ERROR</b> The username '%s' (%s) is already taken!" %(username, row_source(user)))
+        summary.add_failure(user, RunSummary.ALREADY_TAKEN, taken=True)
+        return
+
+    usercreated = False
+    try:
+        usercreated = ocinstance.create_user(username,password)
+    except Exception as e:
+        errorclass = classify_error(e)
+        userexisted = getattr(e, 'ocs_code', None) == OCSResponseError.USER_EXISTS
+        if userindex is not None and not userexisted:
+            userindex.release(username)
+
+        report("<b>ERROR</b> Username '%s' (%s) raised: %s | %s" %(username, row_source(user), e, errorclass) )
+        summary.add_failure(user, errorclass, taken=userexisted)
+        return
+
+    if usercreated:
+        summary.created+=1
+        report("User '%s' account creation success: %s" %(username, usercreated) )
+        try:
+            ocinstance.add_user_to_group(username,group)
+        except Exception as e:
+            report("<b>WARNING</b> User '%s' (%s) could not be added to group '%s': %s" %(username, row_source(user), group, e) )
+            summary.add_warning(user, RunSummary.GROUP_FAILED)
+
+
+
+
+class ProvisioningDaemon(object):
+    """Watches a spool directory and provisions every csv file dropped there
+    on a pool of logged in clients. Login, capabilities and the user index are
+    loaded once at startup. Every file gets a report in SPOOLDIR/reports and is
+    moved to SPOOLDIR/done (or SPOOLDIR/failed) afterwards.
+    """
+
+    def __init__(self, spooldir, url, admin_username, admin_password, group, **kwargs):
+        """
+        :param spooldir: directory to watch for csv files
+        :param url: URL of the target nextCloud instance
+        :param admin_username: user id of the admin
+        :param admin_password: password of the admin
+        :param group: name of the group new users are added to
+        :param workers: number of logged in client sessions, defaults to 2
+        :param interval: polling interval in seconds, defaults to 5
+        :param tracer: RequestTracer passed to all clients, defaults to None
+        """
+        self.spooldir = os.path.abspath(spooldir)
+        self.reportdir = os.path.join(self.spooldir, 'reports')
+        self.donedir = os.path.join(self.spooldir, 'done')
+        self.faileddir = os.path.join(self.spooldir, 'failed')
+        self.url = url
+        self.admin_username = admin_username
+        self.admin_password = admin_password
+        self.group = group
+        self.workers = kwargs.get('workers', 2)
+        self.interval = kwargs.get('interval', 5.0)
+        self.tracer = kwargs.get('tracer', None)
+
+        self.userindex = UserIndex(confirm=True)   # users may be deleted while the service is running
+        self._stopping = threading.Event()
+        self._queue = six.moves.queue.Queue()
+        self._queued = set()
+        self._ignored = set()   # (path, inode, mtime) of files that could not be reported or moved, skipped until restart
+        self._lock = threading.Lock()
+        self._clients = []
+
+    def log(self, line):
+        print("%s  %s" % (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), line))
+        sys.stdout.flush()
+
+    def start(self):
+        """logs in all client sessions, loads the user index and starts the worker threads
+
+        :raises: HTTPResponseError in case login fails, ValueError if the group does not exist
+        """
+        if self.tracer is not None and self.tracer.profile_path:
+            self.log("NEXTCLOUDUSERS_PROFILE is ignored in watch mode, profiling only covers the GUI worker")
+        for directory in (self.reportdir, self.donedir, self.faileddir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        for i in range(self.workers):
+            ocinstance = Client(self.url, tracer=self.tracer)
+            ocinstance.login(self.admin_username, self.admin_password)
+            self._clients.append(ocinstance)
+
+        if not self._clients[0].group_exists(self.group):
+            raise ValueError("The group %s does not exist" % self.group)
+        self.userindex.warm_up(self._clients[0])
+        self.log("%d sessions logged in, %d existing users" % (len(self._clients), len(self.userindex)))
+
+        for ocinstance in self._clients:
+            thread = threading.Thread(target=self._work, args=(ocinstance,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """lets the workers finish the files they are processing, files that have not been
+        started yet stay in the spool directory, then logs out all sessions"""
+        self._stopping.set()
+        self._queue.join()
+        for ocinstance in self._clients:
+            ocinstance.logout()
+        self._clients = []
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def run(self):
+        """starts the pool and watches the spool directory until interrupted"""
+        signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            self.start()
+            if INotify is not None:
+                self._watch_inotify()
+            else:
+                self._watch_polling()
+        except (KeyboardInterrupt, SystemExit):
+            self.log("stopping")
+        finally:
+            self.stop()
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+
+    def _spoolfiles(self):
+        for name in sorted(os.listdir(self.spooldir)):
+            path = os.path.join(self.spooldir, name)
+            if name.endswith('.csv') and os.path.isfile(path):
+                yield path
+
+    @staticmethod
+    def _filekey(path):
+        """identifies a spool file by path, inode and mtime - None if it is gone"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (path, stat.st_ino, stat.st_mtime)
+
+    def _enqueue(self, path):
+        key = self._filekey(path)
+        if key is None:
+            return
+        with self._lock:
+            if path in self._queued or key in self._ignored:
+                return
+            self._queued.add(path)
+        self.log("queued %s" % path)
+        self._queue.put(path)
+
+    def _watch_inotify(self):
+        """files are complete once they are closed after writing or moved into the spool directory,
+        files that are already there at startup are queued once their size has settled"""
+        inotify = INotify()
+        inotify.add_watch(self.spooldir, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        pending = self._settle({}, self._spoolfiles())
+        while True:
+            for event in inotify.read(timeout=int(self.interval * 1000)):
+                path = os.path.join(self.spooldir, event.name)
+                if event.name.endswith('.csv') and os.path.isfile(path):
+                    pending.pop(path, None)
+                    self._enqueue(path)
+            if pending:
+                pending = self._settle(pending, list(pending))
+
+    def _watch_polling(self):
+        """files are complete once their size did not change between two scans"""
+        sizes = {}
+        while True:
+            sizes = self._settle(sizes, self._spoolfiles())
+            time.sleep(self.interval)
+
+    def _settle(self, sizes, paths):
+        """queues every file whose size is the same as in sizes
+
+        :param sizes: dict path -> size of the previous scan
+        :param paths: files to check
+        :returns: dict path -> size of the files that are not settled yet
+        """
+        unsettled = {}
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:   # processed and moved away in the meantime
+                continue
+            if sizes.get(path) == size:
+                self._enqueue(path)
+            else:
+                unsettled[path] = size
+        return unsettled
+
+    def _work(self, ocinstance):
+        while True:
+            path = self._queue.get()
+            try:
+                if not self._stopping.is_set():
+                    self._process(ocinstance, path)
+            except Exception as e:   # the worker must survive every file
+                self.log("%s: processing failed: %s" % (os.path.basename(path), e))
+                self._ignore(path)
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+                self._queue.task_done()
+
+    def _process(self, ocinstance, path):
+        name = os.path.basename(path)
+        if not os.path.isfile(path):   # queued twice, already processed
+            return
+        target = self.donedir
+
+        try:
+            stamped, reportfile = self._open_report(name)
+        except (IOError, OSError) as e:
+            self.log("%s: could not write report, file left in spool: %s" % (name, e))
+            self._ignore(path)
+            return
+
+        with reportfile:
+            def report(line):
+                reportfile.write(re.sub('<[^>]+>', '', line) + "\n")
+
+            try:
+                stats = collections.Counter()
+                users = merge_userfiles([path], report, stats)   # rows are provisioned while the file is read
+                summary = provision_users(ocinstance, self.group, users, report, self.userindex)
+                usercount = stats['rows'] - stats['duplicates']
+                report("Found %d usernames, skipped %d duplicates and %d invalid lines and replaced specialcharacters in %s." % (usercount, stats['duplicates'], stats['skipped'], stats['changed']))
+                for line in summary.summary_lines():
+                    report(line)
+                replayfile = os.path.join(self.reportdir, replay_path(stamped))
+                if summary.write_replay(replayfile):
+                    report("Failed rows written to %s" % replayfile)
+                takenfile = os.path.join(self.reportdir, replay_path(stamped, "taken"))
+                if summary.write_taken(takenfile):
+                    report("Rows with existing usernames written to %s" % takenfile)
+                self.log("%s: %s out of %s User Accounts created" % (name, summary.created, usercount))
+                if summary.aborted is not None:
+                    target = self.faileddir
+            except Exception as e:
+                report("<b>ERROR</b> processing stopped: %s" % e)
+                self.log("%s: processing stopped: %s" % (name, e))
+                target = self.faileddir
+
+        try:
+            shutil.move(path, os.path.join(target, stamped))
+        except (IOError, OSError) as e:
+            self.log("%s: could not be moved to %s: %s" % (name, target, e))
+            self._ignore(path)
+
+    def _open_report(self, name):
+        """creates a new report for a spool file, names get a timestamp so files dropped
+        again under the same name do not overwrite earlier reports, replay files or done/ copies
+
+        :returns: tuple (stamped name e.g. roster.20181015-093000.csv, open report file)
+        """
+        root, ext = os.path.splitext(name)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        count = 1
+        while True:
+            suffix = stamp if count == 1 else "%s-%d" % (stamp, count)
+            stamped = "%s.%s%s" % (root, suffix, ext)
+            try:
+                return stamped, open(os.path.join(self.reportdir, stamped + '.report'), 'x')
+            except FileExistsError:
+                count += 1
+
+    def _ignore(self, path):
+        key = self._filekey(path)
+        if key is not None:
+            with self._lock:
+                self._ignored.add(key)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
 class MeinDialog(QtWidgets.QDialog):
     def __init__(self):
         QtWidgets.QDialog.__init__(self)
@@ -435,6 +1241,7 @@ class MeinDialog(QtWidgets.QDialog):
         self.ui.exit.clicked.connect(self.onAbbrechen)        # setup Slots
         self.ui.start.clicked.connect(self.testLogindata)
         self.ui.pickfile.clicked.connect(self.selectFile)
+        self.ui.pickdir.clicked.connect(self.selectDirectory)
 
         self.extraThread = QtCore.QThread()
         self.worker = Worker(self)
@@ -456,9 +1263,11 @@ class MeinDialog(QtWidgets.QDialog):
         self.admin_password = ""
         self.group = "students"
         self.users = ""
+        self.userfiles = []
         self.usercount = 0
         self.createdusercount = 0
         self.ocinstance = ""
+        self.tracer = tracer_from_environment()   # NEXTCLOUDUSERS_TRACE / NEXTCLOUDUSERS_PROFILE
  
     def updateProgress(self, line):
         self.ui.errorlabel.setText("<b>%s</b>" %line)
@@ -472,76 +1281,57 @@ class MeinDialog(QtWidgets.QDialog):
 
     def selectFile(self):
         """
-        parses a comma separated textfile csv for usernames and passwords
-        replaces all specialcharacters in usernames
-        populates self.users
+        lets the user pick one or more comma separated textfiles csv
         """
         filedialog = QtWidgets.QFileDialog()
         filedialog.setDirectory(USER_HOME_DIR)  # set default directory
-        file_patharray = filedialog.getOpenFileName()  # get filename
-        file_path = file_patharray[0]
-        filename = file_path.rsplit('/', 1)
-        count = 1
-        users = []
-        try:
-            file_lines = open(file_path, 'r').readlines()
-        except IOError:
+        file_patharray = filedialog.getOpenFileNames()  # get filenames
+        self.loadUserfiles(file_patharray[0])
+
+    def selectDirectory(self):
+        """
+        lets the user pick a directory, all csv files in it are loaded
+        """
+        directory = QtWidgets.QFileDialog.getExistingDirectory(None, "", USER_HOME_DIR)
+        if directory:
+            self.loadUserfiles([directory])
+
+    def loadUserfiles(self, paths):
+        """
+        parses the csv files for usernames and passwords, merges them into one batch
+        and skips usernames that are defined more than once
+        the batch is loaded in full because the confirmation dialog lists all users
+        replaces all specialcharacters in usernames
+        populates self.users
+        """
+        if not paths:
             print ("no file selected")
             return
-        
-        if file_lines != "":
-            for line in file_lines:
-                if line == "\n":
-                    continue
-                fields = [final.strip() for final in line.split(',')]
-                if not len(fields) in [3]:
-                    self.updateProgress("%d fields: %s" %(len(fields), fields))
-                    self.updateProgress("Line %d has less or more than 3 fields. Skip." % count)
-                    count += 1
-                    continue
-                users.append(fields)
-             
+        stats = collections.Counter()
+        try:
+            file_paths = expand_userfiles(paths)
+            users = list(merge_userfiles(file_paths, self.updateProgress, stats))
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            self.updateProgress("Could not read file: %s" % e)
+            return
+        if not file_paths:
+            self.updateProgress("No csv files found in %s" % ", ".join(paths))
+            return
+
         self.usercount = len(users)
         self.users = users
+        self.userfiles = file_paths
         
         self.tolog("Usernames:\n")
-        userchanged = False
-        changecount = 0
-        for user in self.users:  ## replace specialcharacters in usernames ! äöüßé
-            user[0] = user[0].lower().replace(" ", "")
-            user[1] = user[1].lower().replace(" ", "")
-     
-            chars = set('âáàäèéêěëìíǐîïòǒóôõöùǔúûüćĉčß')
-            if any((c in chars) for c in user[0]) or any((c in chars) for c in user[1]):
-                
-                user[0] = re.sub("[âáà]", "a", user[0])
-                user[0] = re.sub("[ä]", "ae", user[0])
-                user[0] = re.sub("[èéêěë]", "e", user[0])
-                user[0] = re.sub("[ìíǐîï]", "i", user[0])
-                user[0] = re.sub("[òǒóôõ]", "o", user[0])
-                user[0] = re.sub("[ö]", "oe", user[0])
-                user[0] = re.sub("[ùǔúû]", "u", user[0])
-                user[0] = re.sub("[ü]", "ue", user[0])
-                user[0] = re.sub("[ćĉč]", "c", user[0])
-                user[0] = re.sub("[ß]", "ss", user[0])
-               
-                user[1] = re.sub("[âáà]", "a", user[1])
-                user[0] = re.sub("[ä]", "ae", user[1])
-                user[1] = re.sub("[èéêěë]", "e", user[1])
-                user[1] = re.sub("[ìíǐîï]", "i", user[1])
-                user[1] = re.sub("[òǒóôõ]", "o", user[1])
-                user[0] = re.sub("[ö]", "oe", user[1])
-                user[1] = re.sub("[ùǔúû]", "u", user[1])
-                user[0] = re.sub("[ü]", "ue", user[1])
-                user[1] = re.sub("[ćĉč]", "c", user[1])
-                user[1] = re.sub("[ß]", "ss", user[1])
-               
-                changecount += 1
-            
-            self.tolog(">>  %s.%s   [%s]" % (user[0], user[1], user[2]))
-
-        self.updateProgress("Found %d usernames and replaced specialcharacters in %s. (Check Log !)\n" % (self.usercount, changecount))
-        self.ui.filename.setText("'%s'  |  %s Benutzer gefunden" %(filename[1],len(users)))
+        for user in self.users:
+            self.tolog(">>  %s.%s   [%s]   %s" % (user[0], user[1], user[2], row_source(user)))
+
+        self.updateProgress("Found %d usernames in %d files, skipped %d duplicates and %d invalid lines and replaced specialcharacters in %s. (Check Log !)\n" % (self.usercount, len(file_paths), stats['duplicates'], stats['skipped'], stats['changed']))
+        if len(file_paths) == 1:
+            filename = os.path.basename(file_paths[0])
+        else:
+            filename = "%d Dateien" % len(file_paths)
+        self.ui.filename.setText("'%s'  |  %s Benutzer gefunden" %(filename,len(users)))
         return
 
 
@@ -571,7 +1361,7 @@ class MeinDialog(QtWidgets.QDialog):
         self.updateProgress("Trying to log in")
     
         try:
-            self.ocinstance = Client(self.homepage_url)
+            self.ocinstance = Client(self.homepage_url, tracer=self.tracer)
             self.ocinstance.login(self.admin_username, self.admin_password)
         except:  #connection error
             self.updateProgress("Please check the URL. Connection failed.") 
@@ -603,6 +1393,8 @@ class MeinDialog(QtWidgets.QDialog):
     
     def onAbbrechen(self):    # Exit button
         self.ui.close()
+        if self.tracer is not None:
+            self.tracer.close()
         os._exit(0)
 
     def finished(self, createdusers=0):
@@ -616,6 +1408,7 @@ class MeinDialog(QtWidgets.QDialog):
         """toggles ui buttons"""
         self.ui.start.setEnabled(boolean)
         self.ui.pickfile.setEnabled(boolean)
+        self.ui.pickdir.setEnabled(boolean)
         self.ui.domain.setEnabled(boolean)
         self.ui.admin.setEnabled(boolean)
         self.ui.password.setEnabled(boolean)
@@ -652,6 +1445,16 @@ class  Worker(QtCore.QObject):
     processed = QtCore.pyqtSignal(str)
     finished = QtCore.pyqtSignal(int)
 
+    def _emit(self, line):
+        """emits processed and records the time spent in Qt signalling if tracing is enabled"""
+        tracer = self.meindialog.tracer
+        if tracer is None:
+            self.processed.emit(line)
+            return
+        start = time.perf_counter()
+        self.processed.emit(line)
+        tracer.emit({'kind': 'signal', 'signal': 'processed', 'wall_time': time.perf_counter() - start})
+
 
     def createAccounts(self, ocinstance, group, users):   
         """ Shows a confirmation dialog and 
@@ -659,7 +1462,7 @@ class  Worker(QtCore.QObject):
         
         :param ocinstance: instance of the owncloud/nextcloud client
         :param group: name of the group user is to be addded
-        :param users: list of lists [name, surname, password]
+        :param users: list of lists [name, surname, password, source file, line number]
         
         """
         userlist = []
@@ -684,47 +1487,83 @@ class  Worker(QtCore.QObject):
        
        
         # CREATE USERACCOUNTS NOW !!
+        tracer = self.meindialog.tracer
+        if tracer is not None:
+            tracer.start_profile()
         createdusers = 0
-        if str(retval) == "16384":
-            for user in users:
-                username = "%s.%s" %(user[0],user[1])
-                password = user[2]
-                
-                if ocinstance.user_exists(username):    #check if user exists
-                    self.processed.emit("<b>ERROR</b> The username '%s' is already taken!" %username) 
+        try:
+            if str(retval) == "16384":
+                userindex = UserIndex()   # one request for all existing users instead of one search per row
+                try:
+                    userindex.warm_up(ocinstance)
+                except Exception as e:
+                    summary = RunSummary()
+                    summary.abort(users, e)
                 else:
-                    usercreated = False
-                    try:
-                        usercreated = ocinstance.create_user(username,password)         # OCS error: 106 login user has no right to create this account (group admins cant create users without groups)
-                    except Exception as e: 
-                        if "101" in str(e): 
-                            errormsg = "invalid input data"
-                        elif "102" in str(e):
-                            errormsg = "username already exists"
-                        elif "103" in str(e):
-                            errormsg = "unknown error occurred whilst adding the user"
-                        elif "106" in str(e):
-                            errormsg = "insufficent rights to create users in this group"
-                        else: 
-                            errormsg = ""
-                            
-                        self.processed.emit("<b>ERROR</b> Username '%s' raised: %s | %s" %(username, e, errormsg) )
-                        continue
-                    
-                    if usercreated:
-                        createdusers+=1
-                        self.processed.emit("User '%s' account creation success: %s" %(username, usercreated) )
-                        ocinstance.add_user_to_group(username,group)
-        else:
-            ocinstance._session.close()    
-            ocinstance._session = None
-                    
+                    summary = provision_users(ocinstance, group, users, self._emit, userindex)
+                createdusers = summary.created
+                for line in summary.summary_lines():
+                    self._emit(line)
+                replayfile = batch_replay_path(self.meindialog.userfiles)
+                takenfile = batch_replay_path(self.meindialog.userfiles, "taken")
+                try:
+                    if summary.write_replay(replayfile):
+                        self._emit("Failed rows written to '%s' - fix them and load this file again" % replayfile)
+                    if summary.write_taken(takenfile):
+                        self._emit("Rows with existing usernames written to '%s' - rename them and load this file again" % takenfile)
+                except (IOError, OSError) as e:
+                    self._emit("<b>ERROR</b> Could not write replay files: %s" % e)
+            else:
+                ocinstance._session.close()    
+                ocinstance._session = None
+        finally:
+            if tracer is not None:
+                tracer.stop_profile()
         self.finished.emit(createdusers)   
 
 
 
 
-app = QtWidgets.QApplication(sys.argv)
-dialog = MeinDialog()
-dialog.ui.show()   #show user interface
-sys.exit(app.exec_())
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch create nextCloud/ownCloud users from csv files")
+    parser.add_argument('--watch', metavar='SPOOLDIR', help="run as service and provision every csv file dropped into SPOOLDIR")
+    parser.add_argument('--url', help="URL of the nextCloud instance")
+    parser.add_argument('--admin', help="admin user id (password is read from NEXTCLOUDUSERS_PASSWORD)")
+    parser.add_argument('--group', default="students", help="group new users are added to (default: students)")
+    parser.add_argument('--workers', type=_positive_int, default=2, help="number of logged in sessions (default: 2)")
+    parser.add_argument('--interval', type=float, default=5.0, help="polling interval in seconds (default: 5)")
+    args, qtargs = parser.parse_known_args()
+
+    if args.watch:
+        password = os.environ.get('NEXTCLOUDUSERS_PASSWORD', '')
+        if not args.url or not args.admin or not password:
+            parser.error("--watch needs --url, --admin and NEXTCLOUDUSERS_PASSWORD")
+        daemon = ProvisioningDaemon(args.watch, args.url, args.admin, password, args.group,
+                                    workers=args.workers, interval=args.interval,
+                                    tracer=tracer_from_environment())
+        try:
+            daemon.run()
+        except Exception as e:
+            sys.stderr.write("nextcloudusers: watch mode stopped: %s\n" % e)
+            return 1
+        return 0
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qtargs)
+    dialog = MeinDialog()
+    dialog.ui.show()   #show user interface
+    try:
+        return app.exec_()
+    finally:
+        if dialog.tracer is not None:
+            dialog.tracer.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
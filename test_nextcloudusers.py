@@ -0,0 +1,186 @@
+import pytest
+
+pytest.importorskip("PyQt5.QtWidgets")
+pytest.importorskip("requests")
+pytest.importorskip("six")
+
+import nextcloudusers as ncu
+
+
+def row(name, surname, password="secret", source="/tmp/users.csv", line=1):
+    return [name, surname, password, source, line]
+
+
+class StubClient(object):
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+
+    def search_users(self, user_name):
+        return [user for user in self.existing if user_name in user]
+
+    def user_exists(self, user_name):
+        return user_name in self.existing
+
+
+def test_ocs_code_only_from_statuscode():
+    assert ncu.OCSResponseError(102, ocs_code=102).error_class == "username already exists"
+    assert ncu.OCSResponseError(999, ocs_code=999).error_class == "OCS error 999"
+    http_error = ncu.OCSResponseError(500)
+    assert http_error.ocs_code is None
+    assert http_error.error_class == "HTTP error 500"
+
+
+def test_replay_path():
+    assert ncu.replay_path("/a/users.csv") == "/a/users.failed.csv"
+    assert ncu.replay_path("/a/users.failed.csv") == "/a/users.failed.csv"
+    assert ncu.replay_path("/a/users.csv", "taken") == "/a/users.taken.csv"
+    assert ncu.replay_path("/a/users") == "/a/users.failed.csv"
+
+
+def test_run_summary_groups_failures_and_warnings():
+    summary = ncu.RunSummary()
+    summary.created = 1
+    summary.add_failure(row("a", "b", line=1), "invalid input data")
+    summary.add_failure(row("c", "d", line=2), ncu.RunSummary.ALREADY_TAKEN, taken=True)
+    summary.add_failure(row("e", "f", line=3), "invalid input data")
+    summary.add_warning(row("g", "h", line=4), ncu.RunSummary.GROUP_FAILED)
+
+    assert summary.grouped(summary.failures) == {
+        "invalid input data": ["a.b (users.csv:1)", "e.f (users.csv:3)"],
+        ncu.RunSummary.ALREADY_TAKEN: ["c.d (users.csv:2)"],
+    }
+    assert summary.summary_lines()[0] == "1 created, 3 failed, 1 warnings"
+
+
+def test_write_replay_and_taken(tmp_path):
+    replayfile = str(tmp_path / "users.failed.csv")
+    takenfile = str(tmp_path / "users.taken.csv")
+    summary = ncu.RunSummary()
+    summary.add_failure(row("a", "b"), "invalid input data")
+    summary.add_failure(row("c", "d"), ncu.RunSummary.ALREADY_TAKEN, taken=True)
+    summary.abort([row("e", "f")], IOError("connection lost"))
+
+    assert summary.write_replay(replayfile) == 2
+    assert summary.write_taken(takenfile) == 1
+    assert open(replayfile).read() == "a,b,secret\ne,f,secret\n"
+    assert open(takenfile).read() == "c,d,secret\n"
+
+
+def test_write_replay_removes_stale_file(tmp_path):
+    replayfile = tmp_path / "users.failed.csv"
+    replayfile.write_text("a,b,secret\n")
+
+    assert ncu.RunSummary().write_replay(str(replayfile)) == 0
+    assert not replayfile.exists()
+
+
+def test_user_index_claim_and_release():
+    index = ncu.UserIndex()
+    index.warm_up(StubClient(["max.mueller"]))
+
+    assert len(index) == 1
+    assert not index.claim("max.mueller")
+    assert index.claim("eva.meier")
+    assert not index.claim("eva.meier")
+    index.release("eva.meier")
+    assert index.claim("eva.meier")
+
+
+def test_user_index_confirms_taken_usernames():
+    index = ncu.UserIndex(confirm=True)
+    index.warm_up(StubClient(["max.mueller", "deleted.user"]))
+    client = StubClient(["max.mueller"])   # deleted.user was removed after warm_up
+
+    assert not index.claim("max.mueller", client)
+    assert index.claim("deleted.user", client)
+
+
+def test_provision_users_keeps_summary_when_aborted():
+    class FailingClient(StubClient):
+        def create_user(self, user_name, password):
+            return True
+
+        def add_user_to_group(self, user_name, group):
+            pass
+
+        def user_exists(self, user_name):
+            if user_name == "c.d":
+                raise IOError("connection lost")
+            return False
+
+    users = [row("a", "b", line=1), row("c", "d", line=2), row("e", "f", line=3)]
+    summary = ncu.provision_users(FailingClient(), "students", users, lambda line: None)
+
+    assert summary.created == 1
+    assert summary.aborted is not None
+    assert [entry[1] for entry in summary.failures] == ["c.d (users.csv:2)", "e.f (users.csv:3)"]
+
+
+def test_expand_userfiles_skips_replay_files(tmp_path):
+    for name in ("b.csv", "a.csv", "a.failed.csv", "a.taken.csv", "notes.txt"):
+        (tmp_path / name).write_text("")
+
+    assert ncu.expand_userfiles([str(tmp_path)]) == [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]
+    assert ncu.expand_userfiles([str(tmp_path / "a.failed.csv")]) == [str(tmp_path / "a.failed.csv")]
+
+
+def test_merge_userfiles_deduplicates_across_files(tmp_path):
+    first = tmp_path / "5a.csv"
+    second = tmp_path / "5b.csv"
+    first.write_text("Max,Müller,1\nEva,Meier,2\n")
+    second.write_text("\nmax,mueller,3\nTom,Berg\nJan,Ott,4\n")
+    lines = []
+    stats = ncu.collections.Counter()
+
+    users = list(ncu.merge_userfiles([str(first), str(second)], lines.append, stats))
+
+    assert [(user[0], user[1], ncu.row_source(user)) for user in users] == [
+        ("max", "mueller", "5a.csv:1"), ("eva", "meier", "5a.csv:2"), ("jan", "ott", "5b.csv:4")]
+    assert stats['duplicates'] == 1
+    assert stats['skipped'] == 1
+    assert "Duplicate username 'max.mueller' in 5b.csv:2 is already defined in 5a.csv:1. Skip." in lines
+
+
+def test_iter_userfile_skips_lines_that_are_not_utf8(tmp_path):
+    userfile = tmp_path / "users.csv"
+    rows = ["user,n%d,secret\n" % i for i in range(1, 1001)]
+    rows[600] = "user,sch\xf6n,secret\n"
+    userfile.write_bytes("".join(rows).encode("latin-1"))
+    lines = []
+
+    users = list(ncu.iter_userfile(str(userfile), lines.append))
+
+    assert len(users) == 999
+    assert users[-1][4] == 1000
+    assert lines == ["Line 601 in 'users.csv' is not utf-8 encoded. Skip."]
+
+
+def test_iter_userfile_missing_file(tmp_path):
+    with pytest.raises(ncu.UserfileError):
+        list(ncu.iter_userfile(str(tmp_path / "missing.csv"), lambda line: None))
+
+
+def test_batch_replay_path():
+    assert ncu.batch_replay_path(["/a/users.csv"]) == "/a/users.failed.csv"
+    assert ncu.batch_replay_path(["/a/5a/x.csv", "/a/5b/y.csv"]) == "/a/batch.failed.csv"
+    assert ncu.batch_replay_path(["/a/x.csv", "/a/y.csv"], "taken") == "/a/batch.taken.csv"
+
+
+def test_provision_users_reports_where_reading_stopped():
+    class Client(StubClient):
+        def create_user(self, user_name, password):
+            return True
+
+        def add_user_to_group(self, user_name, group):
+            pass
+
+    def rows():
+        yield row("a", "b", line=1)
+        raise ncu.UserfileError("/tmp/users.csv", 2, OSError("I/O error"))
+
+    lines = []
+    summary = ncu.provision_users(Client(), "students", rows(), lines.append)
+
+    assert summary.created == 1
+    assert isinstance(summary.aborted, ncu.UserfileError)
+    assert "Reading stopped at users.csv:2: I/O error" in lines[-1]